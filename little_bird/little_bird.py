@@ -2,17 +2,45 @@
 
 #
 
-import contextlib
+import re
+import time
+import queue
+import threading
 import http.client
 import requests
+import itertools
+import concurrent.futures
 import datetime
+import urllib.parse
 
 from typing import List, Tuple, Dict, Iterable
 
 import requests_oauthlib
 
+try:
+    # Optional, faster JSON (de)serialization
+    import orjson
+except ImportError:
+    orjson = None
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 TWEET_MAX_LEN = 280
 
+# Max number of tweet ids per request to the `/2/tweets` endpoint
+MAX_IDS_PER_REQUEST = 100
+
+API_ROOT = "https://api.twitter.com"
+
+_UTC = datetime.timezone.utc
+
+# Keyword arguments accepted by `OAuth1Session`
+_ALLOWED_OAUTH_KEYS = frozenset(requests_oauthlib.OAuth1Session.__init__.__code__.co_varnames) - {'self', 'kwargs'}
+
+# Keep-alive connections to `API_ROOT` held by the session
+MAX_CONNECTIONS = 16
+
 
 class TwitterError(BaseException):
     pass
@@ -40,23 +68,140 @@ def parse(response: requests.Response) -> Tuple[requests.Response, Dict]:
         `TwitterError` as above.
     """
 
+    # Repeated keys such as 'id' or 'text' are not interned here:
+    # `json` already reuses key strings within a response,
+    # and `orjson` also caches short keys across responses.
     try:
-        content = response.json()
-        assert isinstance(content, dict)
-    except:
+        content = orjson.loads(response.content) if orjson else response.json()
+    except ValueError:
+        content = None
+
+    if not isinstance(content, dict):
         raise Exception(f"Cannot parse the response. Status {response.status_code}: {response.text}.")
 
-    try:
-        raise TwitterError(content['errors'])
-    except KeyError:
-        pass
+    errors = content.get('errors')
+
+    if errors is not None:
+        raise TwitterError(errors)
 
     return (response, content)
 
 
+class _RateLimitedAdapter(HTTPAdapter):
+    """
+    `HTTPAdapter` that holds back requests to an endpoint
+    whose rate limit window is exhausted until the window resets,
+    as reported by Twitter in the 'x-rate-limit-*' response headers.
+
+    A request rejected with 429 (Too Many Requests) is resent
+    once the window resets, and one failing with a transient 5xx
+    after an exponential backoff; it is re-signed with `auth` if given.
+    After `max_resends` resends the last response is returned as is.
+    """
+
+    # Server errors worth resending
+    TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+    def __init__(self, *args, auth=None, max_resends=5, backoff_factor=0.5, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.auth = auth
+        self.max_resends = max_resends
+        self.backoff_factor = backoff_factor
+
+        # (method, endpoint) -> timestamp at which its rate limit resets
+        self.resets = {}
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        # E.g. '/2/users/12/tweets' -> '/2/users/:id/tweets'
+        return re.sub(r"(?<=.)/\d+(?=/|$)", "/:id", urllib.parse.urlsplit(url).path)
+
+    def send(self, request, **kwargs):
+        # Twitter limits e.g. GET and POST on '/2/tweets' separately
+        key = (request.method, self.endpoint(request.url))
+
+        for attempt in range(self.max_resends + 1):
+            wait = self.resets.get(key, 0) - time.time()
+
+            if wait > 0:
+                interruptible_sleep(wait)
+
+            response = super().send(request, **kwargs)
+
+            reset = response.headers.get('x-rate-limit-reset')
+
+            if (reset is not None) and (response.headers.get('x-rate-limit-remaining') == "0"):
+                self.resets[key] = float(reset)
+
+            if attempt == self.max_resends:
+                break
+
+            if (response.status_code == http.client.TOO_MANY_REQUESTS) and (reset is not None):
+                # Wait at least a moment even if the clocks disagree
+                self.resets[key] = max(float(reset), time.time() + 1)
+            elif response.status_code in self.TRANSIENT_STATUSES:
+                interruptible_sleep(self.backoff_factor * (2 ** attempt))
+            else:
+                return response
+
+            response.close()
+
+            if self.auth is not None:
+                # The OAuth1 nonce and timestamp must be fresh
+                request = request.copy()
+                request.headers.pop('Authorization', None)
+                request = self.auth(request)
+
+        return response
+
+
+# Per thread, an optional `threading.Event` that cuts short
+# the waits of `_RateLimitedAdapter`, see `interruptible_sleep`
+_interrupt = threading.local()
+
+
+def interruptible_sleep(seconds: float):
+    """
+    Like `time.sleep` but raises `InterruptedError` as soon as
+    the event `_interrupt.event` of the current thread (if any) is set.
+    """
+
+    event = getattr(_interrupt, 'event', None)
+
+    if event is None:
+        time.sleep(seconds)
+    elif event.wait(seconds):
+        raise InterruptedError("Waiting for the Twitter API was interrupted.")
+
+
+def pool_size(n: int) -> int:
+    """
+    Number of worker threads for `n` concurrent tasks,
+    capped by the connections kept alive by the session.
+    """
+
+    return max(1, min(n, MAX_CONNECTIONS))
+
+
+def id_chunks(ids: List[str]) -> List[str]:
+    """
+    Validates a list of tweet ids and splits it into comma-separated
+    strings of at most `MAX_IDS_PER_REQUEST` ids, one per request.
+
+    Raises:
+        ValueError: If `ids` is clearly malformed.
+    """
+
+    if (not isinstance(ids, list)) or (not ids) or (not all(ids)):
+        raise ValueError("A list of tweet ids is required.")
+
+    return [",".join(ids[i:(i + MAX_IDS_PER_REQUEST)]) for i in range(0, len(ids), MAX_IDS_PER_REQUEST)]
+
+
 def strftime(timestamp):
-    t = datetime.datetime.fromtimestamp(timestamp).astimezone(tz=datetime.timezone.utc)
-    return t.strftime("%Y-%m-%dT%H:%M:%SZ")
+    t = datetime.datetime.fromtimestamp(timestamp, tz=_UTC)
+    return f"{t.year:04d}-{t.month:02d}-{t.day:02d}T{t.hour:02d}:{t.minute:02d}:{t.second:02d}Z"
 
 
 class LittleBird:
@@ -89,22 +234,44 @@ class LittleBird:
             for (k, v) in auth_params.items()
         }
 
-        allowed_keys = set(requests_oauthlib.OAuth1Session.__init__.__code__.co_varnames) - {'self', 'kwargs'}
-
-        assert set(self.oauth_params.keys()).issubset(allowed_keys), \
+        assert _ALLOWED_OAUTH_KEYS.issuperset(self.oauth_params), \
             f"Unexpected arguments supplied in `oauth_params`."
 
+        # `OAuth1Session` shared by all API calls. Reusing the session keeps
+        # the connections to the API alive between calls, and
+        # the OAuth1 signing client of the session is built once.
+        self._session = requests_oauthlib.OAuth1Session(**self.oauth_params)
+
+        # HTTP/1.1 keep-alive pool; every request is still signed anew
+        # because OAuth1 requires a fresh nonce and timestamp per request
+        self._session.mount(
+            API_ROOT,
+            _RateLimitedAdapter(
+                auth=self._session.auth,
+                pool_connections=1,
+                pool_maxsize=MAX_CONNECTIONS,
+                # Connection errors only: such a request has not reached Twitter,
+                # so its signature may be reused; 429 and 5xx responses are
+                # resent with a new signature by `_RateLimitedAdapter`
+                max_retries=Retry(total=5, read=0, backoff_factor=0.5),
+            ),
+        )
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        # Releases the pooled connections
+        self._session.close()
+
+    def _concurrently(self, func, args: list) -> list:
+        """
+        Maps `func` over `args` in a thread pool so that the requests
+        overlap on the shared session. The order of results follows `args`.
+        """
 
-    @contextlib.contextmanager
-    def oauth(self) -> requests_oauthlib.OAuth1Session:
-        with requests_oauthlib.OAuth1Session(**self.oauth_params) as oauth:
-            assert oauth.authorized
-            yield oauth
+        with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size(len(args))) as executor:
+            return list(executor.map(func, args))
 
     def verify_credentials(self):
         """
@@ -119,17 +286,21 @@ class LittleBird:
             TwitterError, normally when authentication fails.
         """
 
-        with self.oauth() as oauth:
-            url = "https://api.twitter.com/1.1/account/verify_credentials.json"
-            (response, content) = parse(oauth.get(url))
+        oauth = self._session
+
+        url = "https://api.twitter.com/1.1/account/verify_credentials.json"
+        (response, content) = parse(oauth.get(url))
 
-            if response.status_code == 200:
-                return content
+        if response.status_code == 200:
+            return content
 
-            raise Exception(f"Status {response.status_code}: {content}.")
+        raise Exception(f"Status {response.status_code}: {content}.")
 
     def get_tweets_by_id(self, ids: List[str]):
         """
+        Requests for more than `MAX_IDS_PER_REQUEST` ids are split up
+        and issued concurrently; the order of the tweets is preserved.
+
         Args:
             ids: Tweet ids as strings, e.g. ['20', '21'].
 
@@ -142,17 +313,49 @@ class LittleBird:
             TwitterError: Generally if the response is in form {'errors': ...}.
         """
 
-        if (not ids) or (not isinstance(ids, list)) or (not all(ids)):
-            raise ValueError("A list of tweet ids is required.")
+        chunks = id_chunks(ids)
 
-        with self.oauth() as oauth:
-            url = "https://api.twitter.com/2/tweets"
-            (response, content) = parse(oauth.get(url, params={'ids': ",".join(ids)}))
+        if len(chunks) == 1:
+            return self._get_tweets_by_id(chunks[0])
 
-            if response.status_code not in {200, 400}:
-                raise Exception(f"Status {response.status_code}: {response.text}.")
+        return list(itertools.chain.from_iterable(self._concurrently(self._get_tweets_by_id, chunks)))
 
-            return content['data']
+    def _get_tweets_by_id(self, ids: str) -> List[Dict]:
+        """
+        Single request to the `/2/tweets` endpoint
+        for at most `MAX_IDS_PER_REQUEST` comma-separated tweet ids.
+        """
+
+        oauth = self._session
+
+        url = "https://api.twitter.com/2/tweets"
+        (response, content) = parse(oauth.get(url, params={'ids': ids}))
+
+        if response.status_code not in {200, 400}:
+            raise Exception(f"Status {response.status_code}: {response.text}.")
+
+        return content['data']
+
+    def get_tweets_by_id_batches(self, ids_batches: List[List[str]]) -> List[List[Dict]]:
+        """
+        Concurrent version of `get_tweets_by_id` for several batches of ids.
+
+        Args:
+            ids_batches: List of lists of tweet ids, e.g. [['20'], ['200', '201']].
+
+        Returns:
+            A list with the result of `get_tweets_by_id` for each batch.
+        """
+
+        # All requests of all batches go through one thread pool
+        chunks_by_batch = [id_chunks(ids) for ids in ids_batches]
+        chunks = list(itertools.chain.from_iterable(chunks_by_batch))
+        results = iter(self._concurrently(self._get_tweets_by_id, chunks))
+
+        return [
+            list(itertools.chain.from_iterable(itertools.islice(results, len(batch_chunks))))
+            for batch_chunks in chunks_by_batch
+        ]
 
     def tweet(self, text: str) -> dict:
         """
@@ -172,30 +375,45 @@ class LittleBird:
         else:
             text = text.strip()
 
-        if not text:
+        n = len(text)
+
+        if not n:
             raise ValueError(f"Tweet should not be empty.")
 
-        if len(text) > TWEET_MAX_LEN:
+        if n > TWEET_MAX_LEN:
             raise OverflowError(f"The intended tweet is too long (max: {TWEET_MAX_LEN}).")
 
-        with self.oauth() as oauth:
-            url = "https://api.twitter.com/2/tweets"
-            payload = {'text': text}
-            (response, content) = parse(oauth.post(url, json=payload))
+        oauth = self._session
 
-            if response.status_code == http.client.CREATED:
-                # Tweet created; return the 'data' of the form
-                # {'id': '1457709521896357893', 'text': 'Hello, world!'}
-                return content['data']
+        url = "https://api.twitter.com/2/tweets"
+        payload = {'text': text}
 
-            if response.status_code == http.client.FORBIDDEN:
-                if content.get('detail', "").endswith("duplicate content."):
-                    raise DuplicateTweetError(content)
-                else:
-                    raise TwitterError(content)
+        try:
+            data = orjson.dumps(payload) if orjson else None
+        except orjson.JSONEncodeError:
+            # E.g. lone surrogates, which `json` escapes instead
+            data = None
+
+        if data is not None:
+            response = oauth.post(url, data=data, headers={'Content-Type': "application/json"})
+        else:
+            response = oauth.post(url, json=payload)
+
+        (response, content) = parse(response)
+
+        if response.status_code == http.client.CREATED:
+            # Tweet created; return the 'data' of the form
+            # {'id': '1457709521896357893', 'text': 'Hello, world!'}
+            return content['data']
+
+        if response.status_code == http.client.FORBIDDEN:
+            if content.get('detail', "").endswith("duplicate content."):
+                raise DuplicateTweetError(content)
+            else:
+                raise TwitterError(content)
 
-            # Anomalous situation
-            raise Exception(f"Status {response.status_code}: {content}.")
+        # Anomalous situation
+        raise Exception(f"Status {response.status_code}: {content}.")
 
     def untweet(self, id: str) -> dict:
         """
@@ -209,18 +427,19 @@ class LittleBird:
             Typically the dictionary {'deleted': True}.
         """
 
-        with self.oauth() as oauth:
-            url = f"https://api.twitter.com/2/tweets/{id}"
-            (response, content) = parse(oauth.delete(url))
+        oauth = self._session
 
-            if response.status_code == http.client.FORBIDDEN:
-                raise TwitterError(content)
+        url = f"https://api.twitter.com/2/tweets/{id}"
+        (response, content) = parse(oauth.delete(url))
 
-            if response.status_code == http.client.OK:
-                return content['data']
+        if response.status_code == http.client.FORBIDDEN:
+            raise TwitterError(content)
 
-            # Anomalous situation
-            raise Exception(f"Status {response.status_code}: {content}.")
+        if response.status_code == http.client.OK:
+            return content['data']
+
+        # Anomalous situation
+        raise Exception(f"Status {response.status_code}: {content}.")
 
     def users_by_username(self, usernames: List[str]):
         """
@@ -239,17 +458,31 @@ class LittleBird:
         if (not isinstance(usernames, list)) or (not all((isinstance(x, str) and x) for x in usernames)):
             raise TypeError("A list of usernames is expected.")
 
-        with self.oauth() as oauth:
-            url = "https://api.twitter.com/2/users/by"
-            params = {'usernames': usernames}
-            (response, content) = parse(oauth.get(url, params=params))
+        oauth = self._session
 
-            if response.status_code == http.client.OK:
-                return content['data']
+        url = "https://api.twitter.com/2/users/by"
+        params = {'usernames': usernames}
+        (response, content) = parse(oauth.get(url, params=params))
+
+        if response.status_code == http.client.OK:
+            return content['data']
 
         # Anomalous situation
         raise Exception(f"Status {response.status_code}: {content}.")
 
+    def users_by_username_batches(self, usernames_batches: List[List[str]]) -> List[List[Dict]]:
+        """
+        Concurrent version of `users_by_username` for several batches of usernames.
+
+        Args:
+            usernames_batches: List of lists of usernames, e.g. [['jack'], ['elonmusk']].
+
+        Returns:
+            A list with the result of `users_by_username` for each batch.
+        """
+
+        return self._concurrently(self.users_by_username, usernames_batches)
+
     def tweets_by_user_id(self, user_id: str, start_time=None, end_time=None) -> Iterable[Dict]:
         """
         Retrieve all tweets by a given user.
@@ -263,33 +496,150 @@ class LittleBird:
             Tweets in reverse chronological order.
         """
 
+        for data in self._pages_by_user_id(user_id, start_time=start_time, end_time=end_time):
+            yield from data
+
+    def tweets_by_user_id_columnar(self, user_id: str, start_time=None, end_time=None) -> Iterable[Dict[str, list]]:
+        """
+        Like `tweets_by_user_id` but yields one dict of columns per page,
+        e.g. {'id': [...], 'text': [...], 'created_at': [...]},
+        suitable for `pandas.DataFrame` or `pyarrow.Table.from_pydict`.
+
+        Args:
+            user_id: user id (such as '15506669' for @JeffBezos).
+            start_time: timestamp (optional).
+            end_time: timestamp (optional).
+
+        Yields:
+            Pages of tweets in reverse chronological order.
+        """
+
+        fields = ('id', 'text', 'created_at')
+
+        for data in self._pages_by_user_id(user_id, start_time=start_time, end_time=end_time):
+            yield {k: [tweet[k] for tweet in data] for k in fields}
+
+    def tweets_by_user_ids(self, user_ids: List[str], start_time=None, end_time=None) -> Iterable[Tuple[str, Dict]]:
+        """
+        Retrieve all tweets by several users concurrently.
+
+        Timelines are fetched in parallel over the shared session;
+        the rate limits reported by Twitter are respected.
+        Closing the generator stops fetching: no further pages are requested,
+        waits for a rate limit window are cut short, and only requests
+        already sent to Twitter are waited for.
+
+        Args:
+            user_ids: List of user ids, e.g. ['12', '15506669'].
+            start_time: timestamp (optional).
+            end_time: timestamp (optional).
+
+        Yields:
+            Pairs (user_id, tweet), page by page as the pages arrive;
+            within a user, tweets are in reverse chronological order.
+        """
+
+        # Pages (user_id, data) from the workers, or an exception,
+        # or None when a worker is done with its user
+        pages = queue.Queue(maxsize=pool_size(len(user_ids)))
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def timeline(user_id):
+            try:
+                if stop.is_set():
+                    return
+
+                user_pages = self._pages_by_user_id(user_id, start_time=start_time, end_time=end_time, stop=stop)
+
+                try:
+                    for data in user_pages:
+                        if not put((user_id, data)):
+                            break
+                finally:
+                    user_pages.close()
+            except BaseException as ex:
+                put(ex)
+            finally:
+                put(None)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size(len(user_ids)))
+        futures = []
+
+        try:
+            futures = [executor.submit(timeline, user_id) for user_id in user_ids]
+
+            for _ in futures:
+                for item in iter(pages.get, None):
+                    if isinstance(item, BaseException):
+                        raise item
+
+                    (user_id, data) = item
+
+                    for tweet in data:
+                        yield (user_id, tweet)
+        finally:
+            stop.set()
+
+            for future in futures:
+                future.cancel()
+
+            executor.shutdown(wait=True)
+
+    def _pages_by_user_id(self, user_id: str, start_time=None, end_time=None, stop=None) -> Iterable[List[Dict]]:
+        """
+        Pagination for `tweets_by_user_id`; yields the 'data' of each page.
+
+        Setting the `threading.Event` `stop` (optional)
+        interrupts waiting for the rate limit.
+        """
+
         max_results_per_page = 50
 
-        with self.oauth() as oauth:
-            url = f"https://api.twitter.com/2/users/{user_id}/tweets"
+        oauth = self._session
 
-            # https://developer.twitter.com/en/docs/twitter-api/tweets/timelines/api-reference/get-users-id-tweets
-            params = {
-                'tweet.fields': "created_at",
-                'max_results': max_results_per_page,
-            }
+        url = f"https://api.twitter.com/2/users/{user_id}/tweets"
 
-            if start_time:
-                params.update({'start_time': strftime(start_time)})
+        # https://developer.twitter.com/en/docs/twitter-api/tweets/timelines/api-reference/get-users-id-tweets
+        params = {
+            'tweet.fields': "created_at",
+            'max_results': max_results_per_page,
+        }
 
-            if end_time:
-                params.update({'end_time': strftime(end_time)})
+        if start_time:
+            params['start_time'] = strftime(start_time)
 
-            # Pagination loop
-            while True:
-                (response, content) = parse(oauth.get(url, params=params))
+        if end_time:
+            params['end_time'] = strftime(end_time)
 
-                meta = content['meta']
-                data = content['data']
+        def get_page():
+            _interrupt.event = stop
+            return oauth.get(url, params=params)
 
-                yield from data
+        # Pagination loop; the next page is requested
+        # while the current one is being consumed
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(get_page)
+
+            while next_page is not None:
+                (response, content) = parse(next_page.result())
+
+                meta = content['meta']
+                # No 'data' on a page with 'result_count': 0
+                data = content.get('data', [])
 
                 if 'next_token' in meta:
-                    params.update({'pagination_token': meta.get('next_token')})
+                    params['pagination_token'] = meta['next_token']
+                    next_page = executor.submit(get_page)
                 else:
-                    break
+                    next_page = None
+
+                yield data
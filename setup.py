@@ -21,6 +21,7 @@ setuptools.setup(
     ],
     python_requires='>=3.6',
     install_requires=['python-dotenv', 'requests-oauthlib'],
+    extras_require={'orjson': ['orjson']},
 
     # Required for includes in MANIFEST.in
     #include_package_data=True,
@@ -1,15 +1,23 @@
 # RA, 2021-11-08
 
-from unittest import TestCase
+from unittest import TestCase, skipIf
 
+import io
+import contextlib
 import os
+import time
+import itertools
 import datetime
 
 from uuid import uuid4 as unique_id
+from unittest.mock import patch
 
 from dotenv import load_dotenv
 
+import requests
+
 from little_bird import LittleBird
+from little_bird.little_bird import _RateLimitedAdapter, MAX_CONNECTIONS, interruptible_sleep, orjson
 from little_bird import TwitterError, DuplicateTweetError
 
 
@@ -24,6 +32,40 @@ def get_valid_auth_params():
     return auth_params
 
 
+def get_dummy_auth_params():
+    return {
+        'consumer_key': "consumer_key",
+        'consumer_secret': "consumer_secret",
+        'access_token': "access_token",
+        'access_token_secret': "access_token_secret",
+    }
+
+
+def stub_get_tweets_by_id(lb: LittleBird) -> list:
+    """
+    Answers each request-sized chunk of tweet ids offline,
+    with a tweet {'id': ...} per id. Returns the list of requested chunks.
+    """
+
+    requested = []
+
+    def get_tweets_by_id(ids: str):
+        requested.append(ids)
+        return [{'id': id} for id in ids.split(",")]
+
+    lb._get_tweets_by_id = get_tweets_by_id
+
+    return requested
+
+
+def make_response(status_code: int, headers: dict) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    response.raw = io.BytesIO(b"{}")
+    return response
+
+
 class TestLittleBird(TestCase):
     def test_constructor(self):
         LittleBird(auth_params=get_valid_auth_params())
@@ -64,6 +106,44 @@ class TestLittleBird(TestCase):
 
         self.assertEqual(tweets, expected)
 
+    def test_get_tweets_by_id_many(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        requested = stub_get_tweets_by_id(lb)
+
+        ids = [str(i) for i in range(1, 252)]
+
+        tweets = lb.get_tweets_by_id(ids=ids)
+
+        self.assertEqual([100, 100, 51], sorted((len(chunk.split(",")) for chunk in requested), reverse=True))
+        self.assertEqual(ids, [tweet['id'] for tweet in tweets])
+
+    def test_get_tweets_by_id_batches(self):
+        lb = LittleBird(auth_params=get_valid_auth_params())
+
+        batches = lb.get_tweets_by_id_batches(ids_batches=[['20'], ['200']])
+
+        expected = [
+            [{'id': "20", 'text': "just setting up my twttr"}],
+            [{'id': "200", 'text': "trying to get odeo thoughts down"}],
+        ]
+
+        self.assertEqual(batches, expected)
+
+    def test_get_tweets_by_id_batches_share_one_pool(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        requested = stub_get_tweets_by_id(lb)
+
+        ids_batches = [[str(i) for i in range(250)], ['20'], [str(i) for i in range(100)]]
+
+        with patch.object(lb, '_concurrently', wraps=lb._concurrently) as concurrently:
+            batches = lb.get_tweets_by_id_batches(ids_batches=ids_batches)
+
+        self.assertEqual(1, concurrently.call_count)
+        self.assertEqual(5, len(requested))
+        self.assertEqual(ids_batches, [[tweet['id'] for tweet in batch] for batch in batches])
+
     def test_get_tweets_by_id_fails_on_bogus_ids(self):
         lb = LittleBird(auth_params=get_valid_auth_params())
 
@@ -85,6 +165,32 @@ class TestLittleBird(TestCase):
         with self.assertRaises(ValueError):
             lb.tweet(" ")
 
+    def test_tweet_with_lone_surrogate(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        created = make_response(201, {})
+        created._content = b'{"data": {"id": "1", "text": "?"}}'
+
+        # No request to Twitter: the payload is only serialized
+        with patch.object(lb._session, 'post', return_value=created) as post:
+            lb.tweet("Hello \ud800")
+
+        self.assertEqual({'text': "Hello \ud800"}, post.call_args[1]['json'])
+
+    @skipIf(orjson is None, "orjson is not installed")
+    def test_tweet_posts_orjson_bytes(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        created = make_response(201, {})
+        created._content = b'{"data": {"id": "1", "text": "Hello"}}'
+
+        # No request to Twitter: the payload is only serialized
+        with patch.object(lb._session, 'post', return_value=created) as post:
+            lb.tweet("Hello")
+
+        self.assertEqual(b'{"text":"Hello"}', post.call_args[1]['data'])
+        self.assertEqual("application/json", post.call_args[1]['headers']['Content-Type'])
+
     def test_tweet_duplicate(self):
         lb = LittleBird(auth_params=get_valid_auth_params())
         text = str(unique_id())
@@ -128,6 +234,13 @@ class TestLittleBird(TestCase):
         self.assertEqual("JeffBezos", userdata['username'])
         self.assertEqual('15506669', userdata['id'])
 
+    def test_users_by_username_batches(self):
+        lb = LittleBird(auth_params=get_valid_auth_params())
+
+        [[jack], [bezos]] = lb.users_by_username_batches(usernames_batches=[["jack"], ["JeffBezos"]])
+        self.assertEqual("12", jack['id'])
+        self.assertEqual('15506669', bezos['id'])
+
     def test_tweets_by_user_id(self):
         lb = LittleBird(auth_params=get_valid_auth_params())
 
@@ -140,8 +253,214 @@ class TestLittleBird(TestCase):
 
         self.assertEqual(len(list(tweets)), 240)
 
+    def test_tweets_by_user_id_columnar(self):
+        lb = LittleBird(auth_params=get_valid_auth_params())
+
+        user_id = '15506669'
+        end_time = datetime.datetime.fromisoformat("2021-01-01T00:00:00+00:00").timestamp()
+
+        pages = list(lb.tweets_by_user_id_columnar(user_id=user_id, end_time=end_time))
+
+        for page in pages:
+            self.assertEqual({'id', 'text', 'created_at'}, set(page))
+            self.assertEqual(len(page['id']), len(page['created_at']))
+
+        self.assertEqual(sum(len(page['id']) for page in pages), 240)
+
+    def test_tweets_by_user_ids(self):
+        lb = LittleBird(auth_params=get_valid_auth_params())
+
+        user_ids = ['12', '15506669']
+        end_time = datetime.datetime.fromisoformat("2021-01-01T00:00:00+00:00").timestamp()
+
+        tweets = list(lb.tweets_by_user_ids(user_ids=user_ids, end_time=end_time))
+
+        self.assertEqual({'12', '15506669'}, {user_id for (user_id, tweet) in tweets})
+        self.assertEqual(len([tweet for (user_id, tweet) in tweets if (user_id == '15506669')]), 240)
+
+    def test_tweets_by_user_ids_streams_pages(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        fetched = []
+
+        def pages_by_user_id(user_id, start_time=None, end_time=None, stop=None):
+            # Endless timeline, offline
+            for page in itertools.count():
+                fetched.append((user_id, page))
+                yield [{'id': f"{user_id}-{page}-{i}"} for i in range(50)]
+
+        lb._pages_by_user_id = pages_by_user_id
+
+        user_ids = [str(i) for i in range(100)]
+
+        with contextlib.closing(lb.tweets_by_user_ids(user_ids=user_ids)) as stream:
+            tweets = list(itertools.islice(stream, 120))
+
+        self.assertEqual(120, len(tweets))
+
+        # Closing the generator stops the workers after a few pages
+        # and the users not yet started are never fetched
+        self.assertLess(len(fetched), 4 * MAX_CONNECTIONS)
+
+    def test_tweets_by_user_ids_interrupts_rate_limit_wait(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        def get(url, params=None):
+            if "/users/2/" in url:
+                # Waiting for the rate limit window of a busy endpoint
+                interruptible_sleep(900)
+
+            response = make_response(200, {})
+            response._content = b'{"data": [{"id": "1"}], "meta": {"next_token": "next"}}'
+            return response
+
+        with patch.object(lb._session, 'get', side_effect=get):
+            t0 = time.time()
+
+            with contextlib.closing(lb.tweets_by_user_ids(user_ids=['1', '2'])) as stream:
+                tweets = list(itertools.islice(stream, 10))
+
+            self.assertLess(time.time() - t0, 10)
+
+        self.assertEqual([('1', {'id': "1"})] * 10, tweets)
+
+    def test_tweets_by_user_ids_with_empty_timeline(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        def get(url, params=None):
+            response = make_response(200, {})
+            if "/users/2/" in url:
+                # No tweets in the time range
+                response._content = b'{"meta": {"result_count": 0}}'
+            else:
+                response._content = b'{"data": [{"id": "1"}], "meta": {"result_count": 1}}'
+            return response
+
+        with patch.object(lb._session, 'get', side_effect=get):
+            tweets = list(lb.tweets_by_user_ids(user_ids=['1', '2']))
+
+        self.assertEqual([('1', {'id': "1"})], tweets)
+
+    def test_tweets_by_user_ids_raises(self):
+        lb = LittleBird(auth_params=get_dummy_auth_params())
+
+        def pages_by_user_id(user_id, start_time=None, end_time=None, stop=None):
+            yield [{'id': "1"}]
+            raise TwitterError(user_id)
+
+        lb._pages_by_user_id = pages_by_user_id
+
+        with self.assertRaises(TwitterError):
+            list(lb.tweets_by_user_ids(user_ids=['12', '15506669']))
+
     def test_tweet_a_link(self):
         link = "https://www.bbc.com/news"
         lb = LittleBird(auth_params=get_valid_auth_params())
         tweet_id = lb.tweet(str(unique_id()) + " -- " + link).pop('id')
         self.assertDictEqual({'deleted': True}, lb.untweet(tweet_id))
+
+
+class TestRateLimitedAdapter(TestCase):
+    url = "https://api.twitter.com/2/users/12/tweets"
+
+    def setUp(self):
+        self.now = 1000.0
+
+        def sleep(seconds):
+            self.now += seconds
+
+        patches = [
+            patch('time.time', lambda: self.now),
+            patch('time.sleep', side_effect=sleep),
+        ]
+
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def send(self, adapter, responses, method="GET", url=url):
+        request = requests.Request(method, url).prepare()
+        with patch('requests.adapters.HTTPAdapter.send', side_effect=responses) as send:
+            response = adapter.send(request)
+        return (response, send.call_count)
+
+    def test_waits_for_reset_when_exhausted(self):
+        adapter = _RateLimitedAdapter()
+
+        exhausted = {'x-rate-limit-remaining': "0", 'x-rate-limit-reset': "1060"}
+        self.send(adapter, [make_response(200, exhausted)])
+        self.assertEqual(1000.0, self.now)
+
+        # Another user's timeline shares the rate limit
+        (response, calls) = self.send(adapter, [make_response(200, {})], url="https://api.twitter.com/2/users/15506669/tweets")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1060.0, self.now)
+
+    def test_methods_are_limited_separately(self):
+        adapter = _RateLimitedAdapter()
+
+        exhausted = {'x-rate-limit-remaining': "0", 'x-rate-limit-reset': "1900"}
+        self.send(adapter, [make_response(200, exhausted)], url="https://api.twitter.com/2/tweets")
+
+        self.send(adapter, [make_response(201, {})], method="POST", url="https://api.twitter.com/2/tweets")
+        self.assertEqual(1000.0, self.now)
+
+    def test_resends_after_too_many_requests(self):
+        resigned = []
+
+        def auth(request):
+            resigned.append(request)
+            request.headers['Authorization'] = "OAuth fresh"
+            return request
+
+        adapter = _RateLimitedAdapter(auth=auth)
+
+        too_many = make_response(429, {'x-rate-limit-remaining': "0", 'x-rate-limit-reset': "1300"})
+        (response, calls) = self.send(adapter, [too_many, make_response(200, {})])
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, calls)
+        self.assertEqual(1300.0, self.now)
+        self.assertEqual(1, len(resigned))
+
+    def test_resends_after_server_error(self):
+        signatures = iter(["OAuth 2", "OAuth 3"])
+
+        def auth(request):
+            request.headers['Authorization'] = next(signatures)
+            return request
+
+        adapter = _RateLimitedAdapter(auth=auth)
+
+        request = requests.Request("GET", self.url, headers={'Authorization': "OAuth 1"}).prepare()
+        responses = [make_response(503, {}), make_response(503, {}), make_response(200, {})]
+
+        with patch('requests.adapters.HTTPAdapter.send', side_effect=responses) as send:
+            response = adapter.send(request)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            ["OAuth 1", "OAuth 2", "OAuth 3"],
+            [call[0][0].headers['Authorization'] for call in send.call_args_list],
+        )
+
+        # Exponential backoff
+        self.assertEqual(1000.0 + 0.5 + 1.0, self.now)
+
+    def test_gives_up_after_max_resends(self):
+        adapter = _RateLimitedAdapter(max_resends=3)
+
+        # E.g. a usage cap, or a reset time already in the past
+        too_many = [make_response(429, {'x-rate-limit-reset': "900"}) for _ in range(4)]
+        (response, calls) = self.send(adapter, too_many)
+
+        self.assertEqual(429, response.status_code)
+        self.assertEqual(4, calls)
+
+    def test_returns_too_many_requests_without_reset(self):
+        adapter = _RateLimitedAdapter()
+
+        (response, calls) = self.send(adapter, [make_response(429, {})])
+
+        self.assertEqual(429, response.status_code)
+        self.assertEqual(1, calls)